@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from bisect import bisect_left
+
+import requests
+
+# Seconds after which the cached list of barbots is fetched again.
+CACHE_TTL = 24 * 60 * 60
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'caehlcettel', 'barbots.json')
+
+
+class PrefixIndex:
+    """
+    Case-insensitive prefix lookup over a list of names.
+
+    The names are kept sorted by their lower-case form, so all names with
+    a given prefix are one bisect away and sit next to each other.
+    """
+
+    def __init__(self, names=()):
+        entries = sorted({(name.lower(), name) for name in names if name})
+        self._keys = [key for key, name in entries]
+        self._names = [name for key, name in entries]
+
+    def __len__(self):
+        return len(self._names)
+
+    def search(self, prefix, limit=5):
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        start = bisect_left(self._keys, prefix)
+        matches = []
+        for key, name in zip(self._keys[start:start + limit], self._names[start:start + limit]):
+            if not key.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
+
+def fetch_barbots(url, access_token, timeout=5):
+    """
+    Fetch the barbot names from the API.
+
+    Accepts a plain list, or a paginated `{'results': [...]}` response, of
+    names or of objects with a `username`.
+    """
+    names = []
+    while url:
+        resp = requests.get(url, headers={"Authorization": f"Token {access_token}"}, timeout=timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        if isinstance(data, dict):
+            url = data.get('next')
+            data = data.get('results', [])
+        else:
+            url = None
+        for entry in data:
+            names.append(entry['username'] if isinstance(entry, dict) else str(entry))
+    return names
+
+
+class BarbotDirectory:
+    """
+    The list of barbots, cached on disk so suggestions also work offline.
+    """
+
+    def __init__(self, url=None, access_token=None, cache_path=None, ttl=CACHE_TTL):
+        self.url = url
+        self.access_token = access_token
+        self.cache_path = cache_path or default_cache_path()
+        self.ttl = ttl
+        self.fetched_at = None
+        self.index = PrefixIndex()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as cache_fh:
+                cache = json.load(cache_fh)
+        except (OSError, ValueError):
+            return False
+        self.fetched_at = cache.get('fetched_at')
+        self.index = PrefixIndex(cache.get('names', []))
+        return True
+
+    def save_cache(self, names):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as cache_fh:
+            json.dump({'fetched_at': self.fetched_at, 'names': names}, cache_fh)
+        os.replace(tmp_path, self.cache_path)
+
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.ttl
+
+    def refresh(self):
+        """
+        Load the cache and fetch a new list if it is outdated. If the API
+        can't be reached, the cached list is kept.
+        """
+        self.load_cache()
+        if not self.url or not self.is_stale():
+            return self.index
+        try:
+            names = fetch_barbots(self.url, self.access_token)
+        except (requests.RequestException, ValueError, KeyError):
+            return self.index
+        self.fetched_at = time.time()
+        self.index = PrefixIndex(names)
+        try:
+            self.save_cache(names)
+        except OSError:
+            pass
+        return self.index
+
+    def suggest(self, prefix, limit=5):
+        return self.index.search(prefix, limit=limit)
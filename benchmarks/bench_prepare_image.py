@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Compare the image preparation stage with plain `convert(dither=True)`.
+
+    poetry run python benchmarks/bench_prepare_image.py
+"""
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brother_ql.conversion import convert  # noqa: E402
+from brother_ql.raster import BrotherQLRaster  # noqa: E402
+
+from rendering import DITHER_MODES, LABEL, prepare_image  # noqa: E402
+
+IMAGES = [
+    os.path.join(os.path.dirname(__file__), '..', 'testimg.png'),
+    os.path.join(os.path.dirname(__file__), '..', 'testimg2.png'),
+]
+MODEL = 'QL-700'
+NUMBER = 20
+
+logging.getLogger('brother_ql').setLevel(logging.ERROR)
+
+
+def convert_dither(image):
+    return convert(qlr=BrotherQLRaster(MODEL), images=[image], label=LABEL, cut=True, dither=True)
+
+
+def convert_prepared(image, mode):
+    prepared = prepare_image(image, mode=mode)
+    return convert(qlr=BrotherQLRaster(MODEL), images=[prepared], label=LABEL, cut=True, dither=False)
+
+
+def main():
+    for image in IMAGES:
+        print(os.path.basename(image))
+        seconds = timeit.timeit(lambda: convert_dither(image), number=NUMBER) / NUMBER
+        print(f'  {"convert(dither=True)":<24} {seconds * 1000:8.2f} ms')
+        for mode in DITHER_MODES:
+            seconds = timeit.timeit(lambda: convert_prepared(image, mode), number=NUMBER) / NUMBER
+            print(f'  {mode:<24} {seconds * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import asyncio
 import json
 import sys
 import os
 from decimal import Decimal
 from datetime import datetime
+from functools import partial
 
 import requests
 from pyfiglet import Figlet
@@ -16,14 +18,29 @@ from textual.binding import Binding
 from textual.widget import Widget
 from textual.widgets import Header, Footer, Static, Input, Button
 from textual.reactive import reactive
-from textual.containers import Grid
+from textual.containers import Grid, VerticalScroll
 from textual.screen import Screen
 from textual import events
 from textual import log
+from textual.worker import get_current_worker
 
-# from rendering import print_zettel
+from barbots import BarbotDirectory
+from health import HealthMonitor, probe_http, probe_printer
+from metrics import (API_ERRORS, COUNTS_SUBMITTED, PRINT_QUEUE_DEPTH, REGISTRY, SUBMIT_SECONDS,
+                     default_metrics_path, start_http_server, write_file)
+from printing import PrinterPool, default_state_path
+from quickentry import QuickEntryParser
+from scale import CoinCounter, ScaleReader, parse_coin_weights
+from rendering import context_key, halfblock_lines, make_raster, render_image, render_raster
 
 DEFAULT_PRINTER = 'bondruccer.cbrp3.c-base.org'
+DEFAULT_PRINTER_MODEL = 'QL-700'
+# Seconds the count has to stay unchanged before the receipt is pre-rendered.
+PRERENDER_DELAY = 1.0
+# Maximum width of the receipt preview in characters.
+PREVIEW_WIDTH = 100
+# Seconds between two health checks of the API and the printer.
+HEALTH_INTERVAL = 15.0
 
 
 class TotalContainer(Static):
@@ -115,9 +132,13 @@ class CountInput(Static):
 
 
 class QuitScreen(Screen):
+    def __init__(self, *args, **kwargs):
+        self.message = kwargs.pop('message', "Bitte Barbot eingeben.")
+        super().__init__(*args, **kwargs)
+
     def compose(self) -> ComposeResult:
         yield Grid(
-            Static("Bitte Barbot eingeben.", id="question"),
+            Static(self.message, id="question"),
             Button("Okay", variant="primary", id="okay_button"),
             id="dialog",
         )
@@ -129,6 +150,37 @@ class QuitScreen(Screen):
         self.app.pop_screen()
 
 
+class PreviewScreen(Screen):
+    """
+    Shows the receipt as it will be printed.
+    """
+    BINDINGS = [
+        Binding(key="escape", action="app.pop_screen", description="Zurück"),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        self.context = kwargs.pop('context')
+        super().__init__(*args, **kwargs)
+
+    def compose(self) -> ComposeResult:
+        yield VerticalScroll(Static("Vorschau wird erstellt ...", id="preview"))
+        yield Footer()
+
+    def on_mount(self) -> None:
+        width = max(1, min(PREVIEW_WIDTH, self.app.size.width - 4))
+        self.run_worker(partial(self.load_preview, width), name='preview', exit_on_error=False)
+
+    def load_preview(self, width) -> None:
+        try:
+            lines = self.app.preview_lines(self.context, width)
+        except Exception as err:
+            # E.g. wkhtmltoimage is missing, show it instead of waiting forever.
+            preview = Text(f'Vorschau fehlgeschlagen: {str(err).strip() or type(err).__name__}', style='bold red')
+        else:
+            preview = Text('\n'.join(lines), style='black on white')
+        self.app.call_from_thread(self.query_one('#preview', Static).update, preview)
+
+
 class DateTimeDisplay(Static):
     DATE_FORMAT = "%Y-%m-%d %H:%M"
     time = reactive('Titten Gna')
@@ -145,6 +197,91 @@ class DateTimeDisplay(Static):
         self.update(time)
 
 
+class BarbotSuggestions(Static):
+    """
+    Known barbots matching the entered name, Enter takes the first one.
+    """
+    suggestions = reactive(list)
+
+    def render(self) -> RenderResult:
+        return '  '.join(self.suggestions)
+
+
+class HealthDisplay(Static):
+    """
+    Shows the cached results of the health checks.
+    """
+
+    def on_mount(self) -> None:
+        self.set_interval(1.0, self.refresh)
+
+    def render(self) -> RenderResult:
+        parts = []
+        for name in self.app.health.probes:
+            result = self.app.health.status(name)
+            if result is None:
+                parts.append(f'{name}: [yellow]?[/]')
+            elif result['ok']:
+                parts.append(f"{name}: [green]ok[/] ({result['latency'] * 1000:.0f} ms)")
+            else:
+                parts.append(f"{name}: [b red]nicht erreichbar[/]")
+        # The printing times are kept across runs, also for printers that are not probed.
+        for printer in self.app.printers.printers:
+            latency = self.app.printers.latency(printer)
+            if latency is None:
+                continue
+            if printer in self.app.health.probes:
+                parts[list(self.app.health.probes).index(printer)] += f" Ø {latency:.1f} s/Zettel"
+            else:
+                parts.append(f"{printer}: Ø {latency:.1f} s/Zettel")
+        return Text.from_markup('   '.join(parts))
+
+
+def health_probes():
+    """
+    Build the probes for the API and the printers from the environment.
+
+    Without `LOCAL_PRINTER` the API prints on `PRINTER_HOSTNAME`. Those
+    printers are still probed and shown, but as the till doesn't talk to
+    them, `action_print()` doesn't refuse to submit because of them.
+    """
+    probes = {}
+    api_base_url = os.environ.get('API_BASE_URL', None)
+    if api_base_url:
+        probes['API'] = partial(probe_http, api_base_url)
+    for printer in configured_printers():
+        probes[printer] = partial(probe_printer, printer)
+    return probes
+
+
+def barbots_url():
+    """
+    The URL of the barbot list, `BARBOTS_URL` or `barbots/` of the API.
+    """
+    if os.environ.get('BARBOTS_URL'):
+        return os.environ['BARBOTS_URL']
+    api_base_url = os.environ.get('API_BASE_URL', None)
+    if api_base_url:
+        return f'{api_base_url}/barbots/'
+    return None
+
+
+def configured_printers():
+    """
+    The comma-separated printers from `LOCAL_PRINTER` or `PRINTER_HOSTNAME`.
+    """
+    printers = os.environ.get('LOCAL_PRINTER') or os.environ.get('PRINTER_HOSTNAME', DEFAULT_PRINTER)
+    return [printer.strip() for printer in printers.split(',') if printer.strip()]
+
+
+def export_metrics():
+    """
+    Write the metrics to `METRICS_FILE`, if set.
+    """
+    if os.environ.get('METRICS_FILE'):
+        write_file(os.environ['METRICS_FILE'])
+
+
 def generate_denominations():
     count_type = os.environ.get('COUNT_TYPE', 'tresencasse')
     if count_type == 'tresencasse':
@@ -209,12 +346,29 @@ class MainApp(App):
     CSS_PATH = "caehlcettel.css"
     BINDINGS = [
         Binding(key="Ctrl+C", action="quit", description="Quit"),
+        Binding(key="f9", action="preview", description="Preview"),
         Binding(key="f11", action="print", description="Print and quit"),
     ]
     DENOMINATIONS = generate_denominations()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The app exits after every count, keep the metrics counting across runs.
+        REGISTRY.load_state(default_metrics_path())
+        self.health = HealthMonitor(health_probes(), max_age=4 * HEALTH_INTERVAL)
+        self.printers = PrinterPool(
+            configured_printers(),
+            strategy=os.environ.get('PRINTER_STRATEGY', 'round-robin'),
+            health=self.health,
+            backend=os.environ.get('PRINTER_BACKEND'),
+            state_path=default_state_path(),
+        )
+        PRINT_QUEUE_DEPTH.set_function(
+            lambda: sum(stats['pending'] for stats in self.printers.stats.values()))
+
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
+        yield Input(name="quickentry", id="quickentry", placeholder='Schnelleingabe, z.B. 50x3 20x7 +safebag 1234')
         for denom, id_name in self.DENOMINATIONS:
             title=f"{denom}"
             name=f"input_{denom}".replace(',', '')
@@ -225,12 +379,68 @@ class MainApp(App):
             yield CountInput(name=name, id=my_id, label=title)
         yield TotalContainer()
         yield Input(name="barbot", id="barbot", placeholder='Barbot')
+        yield BarbotSuggestions()
         yield DateTimeDisplay('Datum / Uhrzeit')
+        yield HealthDisplay()
         yield Footer()
 
     def on_mount(self) -> None:
         self.title = 'c-base console-based caehlcettel'
-        self.query(PositiveNumberInput)[0].focus()
+        self.query_one('#quickentry').focus()
+        self.quick_entry = QuickEntryParser(self.DENOMINATIONS)
+        self.quick_entry_fields = set()
+        self.quick_entry_errors = []
+        # Values written into the fields by the quick entry, whose change events are not manual edits.
+        self.quick_entry_pending = {}
+        self.number_inputs = {
+            number_input.id.replace('id_input_', '', 1): number_input
+            for number_input in self.query(PositiveNumberInput)
+        }
+        self.prerender_timer = None
+        self.prerendered = None
+        self.rendered_image = None
+        self.preview = None
+        # Time of the last change to the count, printed on the receipt. Keeping it
+        # fixed lets the pre-rendered receipt be used after the minute changed.
+        self.counted_at = None
+        self.check_health()
+        self.set_interval(HEALTH_INTERVAL, self.check_health)
+        self.barbots = BarbotDirectory(
+            url=barbots_url(),
+            access_token=os.environ.get('ACCESS_TOKEN', None),
+        )
+        self.run_worker(self.barbots.refresh, name='barbots', group='barbots', exit_on_error=False)
+        if os.environ.get('METRICS_PORT'):
+            try:
+                start_http_server(int(os.environ['METRICS_PORT']), os.environ.get('METRICS_ADDRESS', '127.0.0.1'))
+            except OSError as err:
+                # E.g. the port is in use by another instance, the app works without it.
+                log.error(f"Couldn't serve the metrics on port {os.environ['METRICS_PORT']}: {err}")
+        if os.environ.get('METRICS_FILE'):
+            self.set_interval(HEALTH_INTERVAL, export_metrics)
+        if os.environ.get('SCALE_DEVICE'):
+            self.run_worker(self.read_scale(), name='scale', group='scale', exit_on_error=False)
+
+    async def read_scale(self) -> None:
+        """
+        Put the coin counts from the scale on `SCALE_DEVICE` into the coin field
+        that was focused when the coins were put on the scale.
+        """
+        counter = CoinCounter(parse_coin_weights(os.environ.get('COIN_WEIGHTS', '')))
+        reader = ScaleReader(os.environ['SCALE_DEVICE'], int(os.environ.get('SCALE_BAUDRATE', 9600)))
+        async for grams in reader.weights():
+            focused = self.focused
+            field = None
+            if isinstance(focused, PositiveNumberInput):
+                field = focused.id.replace('id_input_', '', 1)
+            count = counter.reading(grams, field)
+            if count is not None:
+                id_name, coins = count
+                self.number_inputs[id_name].value = str(coins)
+
+    def check_health(self) -> None:
+        self.run_worker(self.health.check, name='health', group='health',
+                        exclusive=True, exit_on_error=False)
 
     def collect_values(self):
         """
@@ -283,9 +493,176 @@ class MainApp(App):
                     pass
         return grand_total
 
+    def build_context(self):
+        """
+        Build the template context for the receipt from the entered values.
+        """
+        state = []
+        for number_input in self.query(PositiveNumberInput):
+            field_id = number_input.id.rsplit('_', 1)[1]
+            if field_id.isnumeric():
+                denomination = Decimal(field_id) / 100
+            else:
+                denomination = Decimal('0.01')
+            try:
+                amount = int(number_input.value or 0)
+            except ValueError:
+                continue
+            if amount <= 0:
+                continue
+            state.append({
+                'label': number_input.parent.label,
+                'amount': amount,
+                'sub_total': denomination * amount,
+            })
+        return {
+            'state': state,
+            'total': self.calculate_total(),
+            'datetime': (self.counted_at or datetime.now()).strftime('%Y-%m-%d, %H:%M Uhr'),
+        }
+
+    def schedule_prerender(self) -> None:
+        """
+        Pre-render the receipt once the count has been idle for a moment.
+        """
+        if not os.environ.get('LOCAL_PRINTER'):
+            return
+        if self.prerender_timer is not None:
+            self.prerender_timer.stop()
+        self.prerender_timer = self.set_timer(PRERENDER_DELAY, self.prerender)
+
+    def prerender(self) -> None:
+        context = self.build_context()
+        if self.prerendered is not None and self.prerendered[0] == context_key(context):
+            return
+        # Exclusive, so a render for an outdated count gets cancelled.
+        self.run_worker(partial(self.render_receipt, context), name='prerender',
+                        group='prerender', exclusive=True, exit_on_error=False)
+
+    def render_receipt(self, context):
+        """
+        Render the receipt to raster instructions, runs in a worker thread.
+        """
+        model = os.environ.get('PRINTER_MODEL', DEFAULT_PRINTER_MODEL)
+        instructions = make_raster([self.receipt_image(context)], model)
+        if not get_current_worker().is_cancelled:
+            self.prerendered = (context_key(context), instructions)
+        return instructions
+
+    def receipt_image(self, context):
+        """
+        The prepared label image for the context, rendered only if the context changed.
+        """
+        key = context_key(context)
+        rendered_image = self.rendered_image
+        if rendered_image is not None and rendered_image[0] == key:
+            return rendered_image[1]
+        image = render_image(context)
+        self.rendered_image = (key, image)
+        return image
+
+    def preview_lines(self, context, width):
+        """
+        The receipt drawn with half-block characters, cached until the context changes.
+        """
+        key = (context_key(context), width)
+        preview = self.preview
+        if preview is not None and preview[0] == key:
+            return preview[1]
+        lines = halfblock_lines(self.receipt_image(context), width)
+        self.preview = (key, lines)
+        return lines
+
+    async def print_receipt(self, context) -> None:
+        """
+        Print the receipt on `LOCAL_PRINTER`, reusing the pre-rendered raster if it is current.
+        """
+        model = os.environ.get('PRINTER_MODEL', DEFAULT_PRINTER_MODEL)
+        prerendered = self.prerendered
+        if prerendered is not None and prerendered[0] == context_key(context):
+            instructions = prerendered[1]
+        else:
+            instructions = await asyncio.to_thread(render_raster, [context], model)
+        try:
+            await asyncio.wrap_future(self.printers.submit(instructions))
+        except Exception:
+            self._exit_renderables.extend([
+                Text.from_markup(f'Printer {printer}: {stats["errors"]} of {stats["jobs"]} jobs failed')
+                for printer, stats in self.printers.stats.items()
+            ])
+            raise
+        finally:
+            await asyncio.to_thread(self.printers.close)
+
+    def apply_quick_entry(self, text) -> None:
+        """
+        Copy the values of the quick-entry expression into the per-field inputs.
+        """
+        values, errors = self.quick_entry.parse(text)
+        # Also clear the fields that were removed from the expression.
+        for id_name in self.quick_entry_fields | set(values):
+            value = str(values[id_name]) if id_name in values else ''
+            number_input = self.number_inputs[id_name]
+            if number_input.value != value:
+                self.quick_entry_pending.setdefault(id_name, []).append(value)
+                number_input.value = value
+        self.quick_entry_fields = set(values)
+        self.quick_entry_errors = errors
+        self.query_one('#quickentry').set_class(bool(errors), 'invalid')
+
+    def sync_quick_entry(self) -> None:
+        """
+        Rewrite the quick-entry expression from the per-field inputs after a
+        field was edited, so the next keystroke in it doesn't overwrite the edit.
+        Tokens that didn't parse, e.g. a `+safebag` still waiting for its number,
+        are kept at the end.
+        """
+        values = {}
+        for id_name, number_input in self.number_inputs.items():
+            try:
+                value = int(number_input.value or 0)
+            except ValueError:
+                continue
+            if value > 0:
+                values[id_name] = value
+        text = ' '.join([self.quick_entry.format(values)] + self.quick_entry_errors).strip()
+        quick_entry = self.query_one('#quickentry')
+        self.quick_entry_fields = set(values)
+        if quick_entry.value != text:
+            quick_entry.value = text
+            quick_entry.cursor_position = len(text)
+
+    def is_quick_entry_change(self, message) -> bool:
+        """Whether the change of a field was made by `apply_quick_entry()`."""
+        pending = self.quick_entry_pending.get(message.input.id.replace('id_input_', '', 1))
+        if pending and message.value in pending:
+            pending.remove(message.value)
+            return True
+        return False
+
     async def on_input_changed(self, message: Input.Changed) -> None:
+        if message.input.id == 'quickentry':
+            self.apply_quick_entry(message.value)
+            return
+        if message.input.id == 'barbot':
+            self.query_one(BarbotSuggestions).suggestions = self.barbots.suggest(message.value.strip())
+            return
+        if not self.is_quick_entry_change(message):
+            self.sync_quick_entry()
+        self.counted_at = datetime.now()
         grand_total = self.calculate_total()
         self.query_one(Total).sum = grand_total
+        self.schedule_prerender()
+
+    def action_preview(self) -> None:
+        self.push_screen(PreviewScreen(context=self.build_context()))
+
+    async def on_input_submitted(self, message: Input.Submitted) -> None:
+        if message.input.id == 'barbot':
+            suggestions = self.query_one(BarbotSuggestions).suggestions
+            if suggestions:
+                message.input.value = suggestions[0]
+                message.input.cursor_position = len(suggestions[0])
 
     async def action_quit(self) -> None:
         await self.shutdown()
@@ -296,12 +673,19 @@ class MainApp(App):
         if not barbot_name:
             self.push_screen(QuitScreen())
             return
-        
-        context = {
-            'state': [],
-            'total': self.calculate_total(),
-            'datetime': datetime.now().strftime('%Y-%m-%d, %H:%M Uhr'),
-        }
+
+        # Fail right away if the last health check could not reach the API,
+        # or none of the printers when printing locally.
+        failures = self.health.failures()
+        failed = [name for name, error in failures]
+        printers_down = (os.environ.get('LOCAL_PRINTER')
+                         and all(printer in failed for printer in self.printers.printers))
+        if 'API' in failed or printers_down:
+            message = '\n'.join(f'{name} nicht erreichbar: {error}' for name, error in failures)
+            self.push_screen(QuitScreen(message=message))
+            return
+
+        context = self.build_context()
         # Get the access tokens for the REST-API
         access_token = os.environ.get('ACCESS_TOKEN', None)
         if not access_token:
@@ -316,15 +700,21 @@ class MainApp(App):
         json_data["count_type"] = os.environ.get('COUNT_TYPE', 'tresencasse')
         counting_url = f'{api_base_url}/count/'
         # Do the request
-        resp = requests.post(
-            url=counting_url,
-            json=json_data,
-            headers={
-                "Authorization": f"Token {access_token}"
-            },
-            timeout=5
-        )
+        try:
+            with SUBMIT_SECONDS.time():
+                resp = requests.post(
+                    url=counting_url,
+                    json=json_data,
+                    headers={
+                        "Authorization": f"Token {access_token}"
+                    },
+                    timeout=5
+                )
+        except requests.RequestException:
+            API_ERRORS.inc(endpoint='count')
+            raise
         if resp.status_code not in [200, 201, 204]:
+            API_ERRORS.inc(endpoint='count')
             self._exit_renderables.extend([
                 Text.from_markup(f"URL: [i blue underline]{counting_url}[/]\n"),
                 Text.from_markup(f'JSON content sent: {json.dumps(json_data, indent=2)}'),
@@ -332,26 +722,51 @@ class MainApp(App):
                 Text.from_markup(f'HTTP response content: {resp.content}'),
             ])
         resp.raise_for_status()
+        COUNTS_SUBMITTED.inc()
+
+        if os.environ.get('LOCAL_PRINTER'):
+            await self.print_receipt(context)
+            self.exit()
+            return
 
         receipt_url = resp.json()['url']
         print_url = receipt_url + 'print/'
-        print_resp = requests.get(
-            url=print_url,
-            params={
-                'printer': os.environ.get('PRINTER_HOSTNAME', DEFAULT_PRINTER),
-            },
-            headers={
-                "Authorization": f"Token {access_token}"
-            },
-            timeout=5
-        )
-        if print_resp.status_code not in [200, 201, 204]:
-            self._exit_renderables.extend([
-                Text.from_markup(f"URL: [i blue underline]{print_url}[/]\n"),
-                Text.from_markup(f'HTTP status code: {print_resp.status_code}'),
-                Text.from_markup(f'HTTP response content: {print_resp.content}'),
-            ])
-        resp.raise_for_status()
+
+        # Only shown on exit if no printer could print the receipt.
+        print_errors = []
+
+        def request_print(printer):
+            try:
+                print_resp = requests.get(
+                    url=print_url,
+                    params={
+                        'printer': printer,
+                    },
+                    headers={
+                        "Authorization": f"Token {access_token}"
+                    },
+                    timeout=5
+                )
+            except requests.RequestException:
+                API_ERRORS.inc(endpoint='print')
+                raise
+            if print_resp.status_code not in [200, 201, 204]:
+                API_ERRORS.inc(endpoint='print')
+                print_errors.extend([
+                    Text.from_markup(f"URL: [i blue underline]{print_url}[/]\n"),
+                    Text.from_markup(f'Printer: {printer}'),
+                    Text.from_markup(f'HTTP status code: {print_resp.status_code}'),
+                    Text.from_markup(f'HTTP response content: {print_resp.content}'),
+                ])
+            print_resp.raise_for_status()
+
+        # Try the printers in turn until the API could print on one of them. After a
+        # read timeout the receipt may still be printed, so don't print it twice.
+        try:
+            self.printers.run(request_print, failover_on=(requests.ConnectionError, requests.HTTPError))
+        except Exception:
+            self._exit_renderables.extend(print_errors)
+            raise
         self.exit()
 
 
@@ -361,3 +776,5 @@ if __name__ == '__main__':
         app.run()
     except Exception as err:
         print(err)
+    finally:
+        export_metrics()
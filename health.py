@@ -0,0 +1,104 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Seconds a single probe may take.
+PROBE_TIMEOUT = 2.0
+# Port of the raw printing service on network label printers.
+RAW_PRINT_PORT = 9100
+
+
+def probe_http(url, timeout=PROBE_TIMEOUT):
+    """
+    Check that an HTTP server answers at all, any status code will do.
+    """
+    requests.head(url, timeout=timeout, allow_redirects=False)
+
+
+def probe_tcp(host, port=RAW_PRINT_PORT, timeout=PROBE_TIMEOUT):
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+
+
+def probe_printer(identifier, timeout=PROBE_TIMEOUT):
+    """
+    Check a printer given as hostname or brother_ql identifier.
+
+    Network printers are probed on their raw printing port, printers on a
+    device file must exist. USB printers can't be probed without claiming
+    them, they always count as reachable.
+    """
+    if identifier.startswith('usb://'):
+        return
+    if identifier.startswith('file://'):
+        path = identifier[len('file://'):]
+        if not os.path.exists(path):
+            raise OSError(f'{path} does not exist')
+        return
+    if identifier.startswith('tcp://'):
+        identifier = identifier[len('tcp://'):]
+    host, _, port = identifier.partition(':')
+    probe_tcp(host, int(port) if port else RAW_PRINT_PORT, timeout=timeout)
+
+
+class HealthMonitor:
+    """
+    Runs a set of probes and caches their results.
+
+    `probes` maps a name to a callable that raises if the target is not
+    reachable. `check()` runs all probes in parallel and is meant to be
+    called periodically from a background thread, everything else only
+    reads the cached results and never blocks.
+    """
+
+    def __init__(self, probes, max_age=60.0):
+        self.probes = probes
+        self.max_age = max_age
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _run_probe(self, name):
+        start = time.time()
+        try:
+            self.probes[name]()
+        except Exception as err:
+            ok, message = False, str(err) or err.__class__.__name__
+        else:
+            ok, message = True, 'ok'
+        return name, {
+            'ok': ok,
+            'message': message,
+            'latency': time.time() - start,
+            'checked_at': time.time(),
+        }
+
+    def check(self):
+        """Run all probes once and return the results."""
+        if not self.probes:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(self.probes)) as pool:
+            results = dict(pool.map(self._run_probe, self.probes))
+        with self._lock:
+            self.results.update(results)
+            return dict(self.results)
+
+    def status(self, name):
+        """The last result for `name`, or None if it is unknown or outdated."""
+        with self._lock:
+            result = self.results.get(name)
+        if result is None or time.time() - result['checked_at'] > self.max_age:
+            return None
+        return result
+
+    def failures(self):
+        """Names and messages of all probes that recently failed."""
+        failures = []
+        for name in self.probes:
+            result = self.status(name)
+            if result is not None and not result['ok']:
+                failures.append((name, result['message']))
+        return failures
@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the histogram buckets.
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def default_metrics_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'caehlcettel', 'metrics.json')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class of the metrics, one value per combination of labels.
+
+    Metrics with `persistent` set are kept in the state file of the
+    registry, if it has one.
+    """
+    type = None
+    persistent = False
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def dump(self):
+        """The values as a JSON serialisable list."""
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def restore(self, values):
+        """Set the values from the output of `dump()`."""
+        with self._lock:
+            for labels, value in values:
+                self._values[tuple(tuple(label) for label in labels)] = value
+
+    def samples(self):
+        """Yield `(suffix, labels, value)` for every sample of the metric."""
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield '', labels, value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A counter, exported as 0 before the first increment. For a counter
+    with labels, the label combinations to export as 0 are given in `labels`.
+    """
+    type = 'counter'
+    persistent = True
+
+    def __init__(self, *args, labels=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        for label_values in labels:
+            self._values[tuple(sorted(label_values.items()))] = 0
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.save_state()
+
+    def samples(self):
+        with self._lock:
+            empty = not self._values
+        if empty:
+            yield '', (), 0
+            return
+        yield from super().samples()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        """Read the value from `function()` whenever the metrics are rendered."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield '', (), self._function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    persistent = True
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = list(counts)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+        self.registry.save_state()
+
+    def restore(self, values):
+        # Values saved with other buckets can't be merged.
+        super().restore(
+            (labels, (counts, total)) for labels, (counts, total) in values
+            if len(counts) == len(self.buckets)
+        )
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', labels + (('le', _format_value(bound)),), count
+            yield '_sum', labels, total
+            yield '_count', labels, counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.state_path = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def load_state(self, path):
+        """
+        Restore the counters and histograms from `path`, and save them there
+        on every change from now on, so they keep counting across runs.
+        """
+        self.state_path = path
+        try:
+            with open(path, 'r') as state_fh:
+                state = json.load(state_fh)
+        except (OSError, ValueError):
+            return
+        for metric in self.metrics:
+            if metric.persistent and metric.name in state:
+                try:
+                    metric.restore(state[metric.name])
+                except (TypeError, ValueError):
+                    logger.warning('Ignoring the saved values of %s', metric.name)
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        with self._lock:
+            state = {metric.name: metric.dump() for metric in self.metrics if metric.persistent}
+            try:
+                os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+                tmp_path = self.state_path + '.tmp'
+                with open(tmp_path, 'w') as state_fh:
+                    json.dump(state, state_fh)
+                os.replace(tmp_path, self.state_path)
+            except OSError:
+                logger.exception('Could not save the metrics to %s', self.state_path)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        return ''.join(metric.render() + '\n' for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+COUNTS_SUBMITTED = Counter('caehlcettel_counts_submitted_total', 'Counts submitted to the API.')
+SUBMIT_SECONDS = Histogram('caehlcettel_submit_seconds', 'Time to submit a count to the API.')
+API_ERRORS = Counter('caehlcettel_api_errors_total', 'Failed requests to the API, by endpoint.',
+                     labels=({'endpoint': 'count'}, {'endpoint': 'print'}))
+RENDER_SECONDS = Histogram('caehlcettel_render_seconds', 'Time to render a receipt in make_zettel.')
+PRINT_SECONDS = Histogram('caehlcettel_print_seconds', 'Time to print a job, by printer. Failed attempts are not included.')
+PRINT_QUEUE_DEPTH = Gauge('caehlcettel_print_queue_depth', 'Print jobs waiting or printing.')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the metrics on `http://address:port/` from a background thread.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
+
+
+def write_file(path, registry=REGISTRY):
+    """
+    Write the metrics to a file, e.g. for the textfile collector of the node exporter.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as metrics_fh:
+        metrics_fh.write(registry.render())
+    os.replace(tmp_path, path)
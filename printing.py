@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from brother_ql.backends import backend_factory, guess_backend
+from brother_ql.reader import interpret_response
+
+from health import PROBE_TIMEOUT, probe_printer
+from metrics import PRINT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class PrinterConnection:
+    """
+    Keeps the backend of one Brother QL printer open across print jobs.
+
+    Jobs are queued with `submit()` and written by a background thread,
+    so the caller does not block while the label prints. Every job gets
+    a `Future` that resolves to a status dict like the one returned by
+    `brother_ql.backends.helpers.send()`.
+    """
+
+    def __init__(self, printer, backend=None, status_timeout=10.0, connect_timeout=PROBE_TIMEOUT):
+        self.printer = printer
+        if backend is None:
+            backend = guess_backend(printer)
+        self.backend = backend
+        self.status_timeout = status_timeout
+        self.connect_timeout = connect_timeout
+        self._device = None
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """Number of jobs waiting to be sent."""
+        return self._jobs.qsize()
+
+    def submit(self, instructions):
+        """Queue raster instructions for printing and return a `Future`."""
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f'printer {self.printer}', daemon=True)
+                self._thread.start()
+            self._jobs.put((instructions, future))
+        return future
+
+    def close(self):
+        """Finish the queued jobs, then close the printer connection."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            if thread is not None:
+                self._jobs.put(None)
+        if thread is not None:
+            thread.join()
+        self._disconnect()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            instructions, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                status = self._send(instructions)
+            except Exception as err:
+                # Drop the connection, the next job will reconnect.
+                self._disconnect()
+                future.set_exception(err)
+            else:
+                future.set_result(status)
+
+    def _connect(self):
+        if self._device is None:
+            if self.backend == 'network':
+                # The network backend connects without a timeout, a host that
+                # drops packets would block for minutes instead of failing over.
+                probe_printer(self.printer, timeout=self.connect_timeout)
+            be = backend_factory(self.backend)
+            self._device = be['backend_class'](self.printer)
+        return self._device
+
+    def _disconnect(self):
+        device, self._device = self._device, None
+        if device is not None:
+            try:
+                device.dispose()
+            except Exception:
+                logger.exception('Could not close connection to %s', self.printer)
+
+    def _send(self, instructions):
+        status = {
+            'instructions_sent': False,
+            'outcome': 'unknown',
+            'printer_state': None,
+            'did_print': False,
+            'ready_for_next_job': False,
+        }
+        device = self._connect()
+        start = time.time()
+        logger.info('Sending %d bytes to %s.', len(instructions), self.printer)
+        device.write(instructions)
+        status['instructions_sent'] = True
+        status['outcome'] = 'sent'
+        if self.backend == 'network':
+            # The network backend does not support reading back the status.
+            return status
+
+        while time.time() - start < self.status_timeout:
+            data = device.read()
+            if not data:
+                time.sleep(0.005)
+                continue
+            try:
+                result = interpret_response(data)
+            except (NameError, ValueError):
+                # brother_ql raises NameError for short or malformed replies.
+                logger.error("Couldn't understand response: %s", data)
+                continue
+            status['printer_state'] = result
+            if result['errors']:
+                logger.error('Errors occured: %s', result['errors'])
+                status['outcome'] = 'error'
+                break
+            if result['status_type'] == 'Printing completed':
+                status['did_print'] = True
+                status['outcome'] = 'printed'
+            if result['status_type'] == 'Phase change' and result['phase_type'] == 'Waiting to receive':
+                status['ready_for_next_job'] = True
+            if status['did_print'] and status['ready_for_next_job']:
+                break
+
+        if not (status['did_print'] and status['ready_for_next_job']):
+            logger.warning('Printing on %s potentially not successful?', self.printer)
+        return status
+
+
+def default_state_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'caehlcettel', 'printers.json')
+
+
+class PrinterPool:
+    """
+    Routes print jobs to one of several printers.
+
+    Printers are tried in the order given by the strategy, either
+    'round-robin' or 'least-queued'. A printer that failed a job, or that
+    the optional `health.HealthMonitor` reports as unreachable, is only
+    tried after all others, so one jammed printer doesn't stall printing.
+    `stats` keeps per-printer job counts and timings.
+
+    With a `state_path`, the round-robin position, the failures and the
+    timings are kept in that file, so they carry over to the next run of
+    the app. The pending jobs compared by 'least-queued' are only the ones
+    of this process.
+    """
+
+    STRATEGIES = ('round-robin', 'least-queued')
+
+    def __init__(self, printers, strategy='round-robin', health=None, backend=None, retry_after=60.0,
+                 state_path=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Strategy `{strategy}` not supported")
+        if not printers:
+            raise ValueError('At least one printer is needed')
+        self.printers = list(printers)
+        self.strategy = strategy
+        self.health = health
+        self.backend = backend
+        self.retry_after = retry_after
+        self.stats = {
+            printer: {'jobs': 0, 'errors': 0, 'printed': 0, 'pending': 0, 'total_time': 0.0, 'failed_at': None}
+            for printer in self.printers
+        }
+        self.state_path = state_path
+        self._connections = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        if state_path is not None:
+            self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r') as state_fh:
+                state = json.load(state_fh)
+        except (OSError, ValueError):
+            return
+        self._next = state.get('next', 0) % len(self.printers)
+        for printer, saved in state.get('printers', {}).items():
+            if printer in self.stats:
+                for name in ('jobs', 'errors', 'printed', 'total_time', 'failed_at'):
+                    if name in saved:
+                        self.stats[printer][name] = saved[name]
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        with self._lock:
+            state = {
+                'next': self._next,
+                'printers': {
+                    printer: {name: value for name, value in stats.items() if name != 'pending'}
+                    for printer, stats in self.stats.items()
+                },
+            }
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as state_fh:
+                json.dump(state, state_fh)
+            os.replace(tmp_path, self.state_path)
+        except OSError:
+            logger.exception('Could not save the printer state to %s', self.state_path)
+
+    def is_up(self, printer):
+        failed_at = self.stats[printer]['failed_at']
+        if failed_at is not None and time.time() - failed_at < self.retry_after:
+            return False
+        if self.health is not None:
+            result = self.health.status(printer)
+            if result is not None and not result['ok']:
+                return False
+        return True
+
+    def candidates(self):
+        """The printers in the order they should be tried."""
+        with self._lock:
+            if self.strategy == 'round-robin':
+                start = self._next
+                self._next = (self._next + 1) % len(self.printers)
+                ordered = self.printers[start:] + self.printers[:start]
+            else:
+                ordered = sorted(self.printers, key=lambda printer: self.stats[printer]['pending'])
+        if self.strategy == 'round-robin':
+            self.save_state()
+        up = [printer for printer in ordered if self.is_up(printer)]
+        return up + [printer for printer in ordered if printer not in up]
+
+    def latency(self, printer):
+        """Mean seconds per printed job on the printer, or None before the first one."""
+        stats = self.stats[printer]
+        if not stats['printed']:
+            return None
+        return stats['total_time'] / stats['printed']
+
+    def connection(self, printer):
+        with self._lock:
+            if printer not in self._connections:
+                self._connections[printer] = PrinterConnection(printer, backend=self.backend)
+            return self._connections[printer]
+
+    def _started(self, printer):
+        with self._lock:
+            self.stats[printer]['pending'] += 1
+        return time.time()
+
+    def _finished(self, printer, started, ok):
+        with self._lock:
+            stats = self.stats[printer]
+            stats['pending'] -= 1
+            stats['jobs'] += 1
+            if ok:
+                elapsed = time.time() - started
+                PRINT_SECONDS.observe(elapsed, printer=printer)
+                stats['printed'] += 1
+                stats['total_time'] += elapsed
+                stats['failed_at'] = None
+            else:
+                stats['errors'] += 1
+                stats['failed_at'] = time.time()
+        self.save_state()
+
+    def run(self, job, failover_on=(Exception,)):
+        """
+        Call `job(printer)` on the candidates in turn until one doesn't raise.
+
+        Only the exception types in `failover_on` move on to the next
+        printer, any other exception is raised right away, e.g. when it
+        is unclear whether the job was printed.
+        """
+        last_error = None
+        for printer in self.candidates():
+            started = self._started(printer)
+            try:
+                result = job(printer)
+            except failover_on as err:
+                logger.warning('Printing on %s failed: %s', printer, err)
+                self._finished(printer, started, ok=False)
+                last_error = err
+                continue
+            except Exception:
+                self._finished(printer, started, ok=False)
+                raise
+            self._finished(printer, started, ok=True)
+            return result
+        raise last_error
+
+    def submit(self, instructions):
+        """
+        Queue raster instructions on the best printer and return a `Future`.
+
+        The job fails over to the next printer if sending fails or the
+        printer reports an error. The resulting status dict also contains
+        the `printer` that printed it.
+        """
+        future = Future()
+        self._submit(instructions, self.candidates(), future, None)
+        return future
+
+    def _submit(self, instructions, candidates, future, last_error):
+        if not candidates:
+            future.set_exception(last_error)
+            return
+        printer, rest = candidates[0], candidates[1:]
+        started = self._started(printer)
+
+        def done(job):
+            error = job.exception()
+            if error is None and job.result()['outcome'] == 'error':
+                error = RuntimeError(f'Printer {printer} reported {job.result()["printer_state"]["errors"]}')
+            self._finished(printer, started, ok=error is None)
+            if error is None:
+                future.set_result(dict(job.result(), printer=printer))
+            else:
+                logger.warning('Printing on %s failed: %s', printer, error)
+                self._submit(instructions, rest, future, error)
+
+        self.connection(printer).submit(instructions).add_done_callback(done)
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+        for connection in connections:
+            connection.close()
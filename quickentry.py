@@ -0,0 +1,121 @@
+from decimal import Decimal, InvalidOperation
+
+
+def _denomination_cents(text):
+    """Cents of a denomination written like `50`, `0,50` or `0.5`, or None."""
+    try:
+        value = Decimal(text.replace(',', '.'))
+    except InvalidOperation:
+        return None
+    if not value.is_finite() or value <= 0:
+        return None
+    cents = value * 100
+    if cents != cents.to_integral_value():
+        return None
+    return int(cents)
+
+
+class QuickEntryParser:
+    """
+    Parses quick-entry expressions like `50x3 20x7 2x41 +safebag 1234`.
+
+    `<denomination>x<count>` adds a count to a denomination, `+<field>`
+    assigns the following number to a field without a denomination, e.g.
+    the safebag. The denominations are the `(label, id_name)` pairs from
+    `generate_denominations()`.
+
+    Parsing is incremental: tokens that are unchanged since the previous
+    call, at the start or the end of the expression, are not parsed again,
+    so a keystroke only costs parsing the token that was edited.
+    """
+
+    def __init__(self, denominations):
+        self.by_cents = {}
+        self.by_name = {}
+        for label, id_name in denominations:
+            if id_name.isnumeric():
+                self.by_cents[int(id_name)] = id_name
+            else:
+                self.by_name[label.lower()] = id_name
+                self.by_name[id_name.split('_', 1)[0].lower()] = id_name
+        self._tokens = []
+        self._parsed = []
+
+    def parse_token(self, token):
+        """
+        Parse one token into `('count', id_name, n)`, `('field', id_name)`,
+        `('number', n)` or `('error', token)`.
+        """
+        if token.startswith('+'):
+            id_name = self.by_name.get(token[1:].lower())
+            if id_name is None:
+                return ('error', token)
+            return ('field', id_name)
+        if token.isdigit():
+            return ('number', int(token))
+        denomination, sep, count = token.lower().partition('x')
+        if not sep or not count.isdigit():
+            return ('error', token)
+        id_name = self.by_cents.get(_denomination_cents(denomination))
+        if id_name is None:
+            return ('error', token)
+        return ('count', id_name, int(count))
+
+    def _parse_tokens(self, tokens):
+        old_tokens, old_parsed = self._tokens, self._parsed
+        limit = min(len(tokens), len(old_tokens))
+        prefix = 0
+        while prefix < limit and tokens[prefix] == old_tokens[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and tokens[-1 - suffix] == old_tokens[-1 - suffix]:
+            suffix += 1
+        parsed = (
+            old_parsed[:prefix]
+            + [self.parse_token(token) for token in tokens[prefix:len(tokens) - suffix]]
+            + old_parsed[len(old_parsed) - suffix:]
+        )
+        self._tokens, self._parsed = tokens, parsed
+        return parsed
+
+    def parse(self, text):
+        """
+        Parse the expression, returns the values per `id_name` and the tokens
+        that could not be understood.
+        """
+        values = {}
+        errors = []
+        field = field_token = None
+        tokens = text.split()
+        for token, item in zip(tokens, self._parse_tokens(tokens)):
+            kind = item[0]
+            if field is not None and kind != 'number':
+                # A `+<field>` that is not followed by its number.
+                errors.append(field_token)
+            if kind == 'count':
+                values[item[1]] = values.get(item[1], 0) + item[2]
+            elif kind == 'field':
+                field, field_token = item[1], token
+                continue
+            elif kind == 'number' and field is not None:
+                values[field] = values.get(field, 0) + item[1]
+            else:
+                errors.append(token)
+            field = field_token = None
+        if field is not None:
+            errors.append(field_token)
+        return values, errors
+
+    def format(self, values):
+        """
+        The expression for the values per `id_name`, the reverse of `parse()`.
+        """
+        tokens = []
+        for cents, id_name in sorted(self.by_cents.items(), reverse=True):
+            if values.get(id_name):
+                euros = str(cents // 100) if cents % 100 == 0 else f'{cents // 100},{cents % 100:02d}'
+                tokens.append(f'{euros}x{values[id_name]}')
+        for id_name in dict.fromkeys(self.by_name.values()):
+            if values.get(id_name):
+                tokens.append(f"+{id_name.split('_', 1)[0].lower()} {values[id_name]}")
+        return ' '.join(tokens)
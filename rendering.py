@@ -1,14 +1,21 @@
+import json
 import os
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import imgkit
 import jinja2
+from PIL import Image, ImageChops
 
 from brother_ql.conversion import convert
 from brother_ql.backends.helpers import send
+from brother_ql.devicedependent import label_type_specs
 from brother_ql.raster import BrotherQLRaster
 
+from metrics import PRINT_SECONDS, RENDER_SECONDS
+
 
 TEMPLATE_FILE = os.path.join(os.path.dirname(__file__), 'templates/zettel.html.j2')
 
@@ -25,15 +32,135 @@ WKHTML_OPTIONS = options = {
     # 'no-outline': None
 }
 
+LABEL = '62'
+
+# 8x8 Bayer matrix for ordered dithering.
+BAYER_8X8 = [
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+]
+
+# Lookup table mapping every non-zero grey value to white.
+NONZERO_LUT = [0] + [255] * 255
+
+DITHER_MODES = ('threshold', 'ordered', 'floyd-steinberg')
+
+# Half-block character for the ink in the (top, bottom) pixel of a terminal cell,
+# indexed by `2 * top + bottom`.
+HALF_BLOCKS = str.maketrans({0: ' ', 1: '\u2584', 2: '\u2580', 3: '\u2588'})
+
+
+class BatchRaster(BrotherQLRaster):
+    """
+    Raster that applies one cut setting to a whole batch of labels.
+
+    `convert()` only knows "cut after every label" or "never cut". This
+    overrides the cut commands it emits so several labels can share one
+    instruction stream and, for example, only be cut at the very end.
+    With `cut_at_end=False` the auto cut is switched off for the last of
+    the `pages`, so it stays attached to the tape.
+    """
+
+    def __init__(self, model, pages, cut_every=1, cut_at_end=True):
+        super().__init__(model)
+        self.batch_pages = pages
+        self.batch_cut_every = cut_every
+        self.batch_cut_at_end = cut_at_end
+        self._page = 0
+
+    def add_autocut(self, autocut=False):
+        self._page += 1
+        if self._page == self.batch_pages and not self.batch_cut_at_end:
+            autocut = False
+        super().add_autocut(autocut)
+
+    def add_cut_every(self, n=1):
+        super().add_cut_every(self.batch_cut_every)
+
+    def add_expanded_mode(self):
+        self.cut_at_end = self.batch_cut_at_end
+        super().add_expanded_mode()
+
+
+def context_key(context):
+    """A string that only changes when the rendered receipt would change."""
+    return json.dumps(context, sort_keys=True, default=str)
+
+
+@lru_cache(maxsize=8)
+def _ordered_dither_map(width, height):
+    """A greyscale image of the Bayer matrix tiled to the given size."""
+    size = len(BAYER_8X8)
+    rows = []
+    for bayer_row in BAYER_8X8:
+        levels = [(value * 256 + 128) // (size * size) for value in bayer_row]
+        rows.append(bytes(levels[x % size] for x in range(width)))
+    block = b''.join(rows)
+    data = block * (height // size + 1)
+    return Image.frombytes('L', (width, height), data[:width * height])
+
+
+@lru_cache(maxsize=8)
+def _threshold_lut(threshold):
+    return tuple(0 if value < threshold else 255 for value in range(256))
+
+
+def prepare_image(image, mode='ordered', threshold=128, trim=True, width=None):
+    """
+    Turn a rendered receipt into a 1-bit image ready for `convert()`.
+
+    The image is put on a white background, trimmed of blank rows at the
+    top and bottom, scaled to the printable width of the label and then
+    thresholded or dithered with one of `DITHER_MODES`. Black stays black,
+    so `convert()` can be called with `dither=False` on the result.
+    """
+    if mode not in DITHER_MODES:
+        raise ValueError(f"Dither mode `{mode}` not supported")
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    if image.mode.endswith('A'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, image.split()[-1])
+        image = background
+    im = image.convert('L')
 
-def make_zettel(context, tmpdir, do_open=False):
-    with open(TEMPLATE_FILE, 'r') as tpl_fh:
-        template = jinja2.Template(tpl_fh.read())
+    if trim:
+        # Rows that contain anything darker than white.
+        bbox = ImageChops.invert(im).getbbox()
+        if bbox is None:
+            im = im.crop((0, 0, im.size[0], 1))
+        else:
+            im = im.crop((0, bbox[1], im.size[0], bbox[3]))
 
-    html = template.render(**context)
-    
-    tmpfile = str(os.path.join(tmpdir, 'out.png'))
-    imgkit.from_string(html, tmpfile, options=WKHTML_OPTIONS)
+    if width is None:
+        width = label_type_specs[LABEL]['dots_printable'][0]
+    if im.size[0] != width:
+        height = max(1, int(width / im.size[0] * im.size[1]))
+        im = im.resize((width, height), Image.LANCZOS)
+
+    if mode == 'threshold':
+        return im.point(list(_threshold_lut(threshold)), '1')
+    if mode == 'ordered':
+        # White wherever the pixel is lighter than the tiled Bayer threshold.
+        return ImageChops.subtract(im, _ordered_dither_map(*im.size)).point(NONZERO_LUT, '1')
+    return im.convert('1', dither=Image.FLOYDSTEINBERG)
+
+
+def make_zettel(context, tmpdir, do_open=False, filename='out.png'):
+    with RENDER_SECONDS.time():
+        with open(TEMPLATE_FILE, 'r') as tpl_fh:
+            template = jinja2.Template(tpl_fh.read())
+
+        html = template.render(**context)
+
+        tmpfile = str(os.path.join(tmpdir, filename))
+        imgkit.from_string(html, tmpfile, options=WKHTML_OPTIONS)
     if do_open is True:
         os.system('open %s' % tmpfile)
         time.sleep(1.0)
@@ -41,14 +168,95 @@ def make_zettel(context, tmpdir, do_open=False):
     return tmpfile
 
 
-def print_zettel(context, tmpdir, backend, model, printer):
-    tmp_filename = make_zettel(context, tmpdir)
-    qlr = BrotherQLRaster(model)
+def make_zettels(contexts, tmpdir, max_workers=None):
+    """Render several contexts concurrently, returns the image filenames in order."""
+    def render(args):
+        index, context = args
+        return make_zettel(context, tmpdir, filename=f'out_{index}.png')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(render, enumerate(contexts)))
+
+
+def make_raster(images, model, cut_between=True, cut_at_end=True, dither_mode='ordered'):
+    """Convert the images into a single raster instruction stream for a 62mm label."""
+    if cut_between:
+        cut_every = 1
+    elif len(images) > 255:
+        # The printer counts the labels between two cuts in a single byte.
+        raise ValueError("Can't print more than 255 labels without cutting between them")
+    else:
+        cut_every = max(1, len(images))
+    qlr = BatchRaster(model, len(images), cut_every=cut_every, cut_at_end=cut_at_end)
     qlr.exception_on_warning = True
     kwargs = {}
-    kwargs['label'] = '62'
-    kwargs['cut'] = True
-    kwargs['dither'] = True
-    kwargs['images'] = [tmp_filename, ]
-    instructions = convert(qlr=qlr, **kwargs)
-    send(instructions=instructions, printer_identifier=printer, backend_identifier=backend, blocking=True)
\ No newline at end of file
+    kwargs['label'] = LABEL
+    kwargs['cut'] = cut_between or cut_at_end
+    kwargs['dither'] = False
+    kwargs['images'] = [prepare_image(image, mode=dither_mode) for image in images]
+    return convert(qlr=qlr, **kwargs)
+
+
+def render_image(context, dither_mode='ordered'):
+    """Render a context to the prepared 1-bit label image."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        return prepare_image(make_zettel(context, tmpdir), mode=dither_mode)
+
+
+def halfblock_lines(image, width, threshold=224):
+    """
+    Draw an image with half-block characters, `width` characters wide.
+
+    Every character covers two pixels on top of each other, so the
+    image keeps its aspect ratio in a terminal with 1:2 cells. The
+    image is scaled down with a box filter and the characters are
+    looked up for the whole image at once, not per pixel.
+    """
+    height = max(2, round(image.size[1] * width / image.size[0] / 2) * 2)
+    small = image.convert('L').resize((width, height), Image.BOX)
+    # 1 where the scaled down pixel is darker than `threshold`, with the default
+    # of 224 that is from about 12% ink on, so thin strokes don't disappear.
+    ink = small.point(_threshold_lut(threshold)).point(lambda value: 0 if value else 1).tobytes()
+    rows = [ink[y * width:(y + 1) * width] for y in range(height)]
+    top = Image.frombytes('L', (width, height // 2), b''.join(rows[0::2]))
+    bottom = Image.frombytes('L', (width, height // 2), b''.join(rows[1::2]))
+    cells = ImageChops.add(ImageChops.add(top, top), bottom).tobytes()
+    text = cells.decode('latin-1').translate(HALF_BLOCKS)
+    return [text[y * width:(y + 1) * width] for y in range(height // 2)]
+
+
+def render_raster(contexts, model, **kwargs):
+    """Render contexts straight to raster instructions, using a temporary directory."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        return make_raster(make_zettels(contexts, tmpdir), model, **kwargs)
+
+
+def print_zettel(context, tmpdir, backend, model, printer, connection=None):
+    """
+    Render the context and print it on a Brother QL printer.
+
+    Without a `connection` this blocks until the label is printed. With a
+    `printing.PrinterConnection` the job is queued on the open connection
+    and the `Future` for its status is returned right away.
+    """
+    return print_zettels([context], tmpdir, backend, model, printer, connection=connection)
+
+
+def print_zettels(contexts, tmpdir, backend, model, printer, cut_between=True, cut_at_end=True,
+                  connection=None):
+    """
+    Render several contexts and print them as one job.
+
+    The labels share a single raster stream, so the printer is only set up
+    once. `cut_between` cuts after every label, `cut_at_end` after the last.
+    """
+    tmp_filenames = make_zettels(contexts, tmpdir)
+    instructions = make_raster(tmp_filenames, model, cut_between=cut_between, cut_at_end=cut_at_end)
+    if connection is not None:
+        return connection.submit(instructions)
+    started = time.perf_counter()
+    status = send(instructions=instructions, printer_identifier=printer, backend_identifier=backend, blocking=True)
+    # Only printed jobs are timed, like in `PrinterPool`.
+    if status['outcome'] != 'error':
+        PRINT_SECONDS.observe(time.perf_counter() - started, printer=printer)
+    return status
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import re
+import termios
+import tty
+
+# Weight of one coin in grams, by the cents of the denomination.
+COIN_WEIGHTS = {
+    '1': 2.30,
+    '2': 3.06,
+    '5': 3.92,
+    '10': 4.10,
+    '20': 5.74,
+    '50': 7.80,
+    '100': 7.50,
+    '200': 8.50,
+}
+
+WEIGHT_RE = re.compile(r'([-+]?\s*\d+(?:[.,]\d+)?)\s*(kg|g)\b', re.IGNORECASE)
+
+
+def parse_coin_weights(text):
+    """
+    Parse coin weights like `200=8.5,100=7.5` on top of the defaults.
+    """
+    weights = dict(COIN_WEIGHTS)
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        cents, _, grams = item.partition('=')
+        weights[cents.strip()] = float(grams)
+    return weights
+
+
+def parse_weight(line):
+    """
+    Weight in grams from a line sent by a counting scale, e.g. `ST,GS,+  75.00 g`.
+
+    Returns None for lines without a weight and for unstable readings.
+    """
+    if line.strip().upper().startswith('US'):
+        return None
+    match = WEIGHT_RE.search(line)
+    if match is None:
+        return None
+    weight = float(match.group(1).replace(' ', '').replace(',', '.'))
+    if match.group(2).lower() == 'kg':
+        weight *= 1000
+    return weight
+
+
+def coins_for_weight(grams, coin_weight):
+    return max(0, round(grams / coin_weight))
+
+
+class CoinCounter:
+    """
+    Turns the stable readings of the scale into coin counts.
+
+    A count is only taken when the weight changes to a new value that is
+    not zero. The field that is focused when coins are put on the empty
+    scale keeps getting the counts until the scale is emptied again, so
+    moving on to the next field doesn't count the coins still on the
+    scale as the next denomination.
+    """
+
+    def __init__(self, coin_weights):
+        self.coin_weights = coin_weights
+        # Below half of the lightest coin the scale counts as empty.
+        self.empty_below = min(coin_weights.values()) / 2
+        self.field = None
+        self.weight = None
+
+    def reading(self, grams, field):
+        """
+        Return `(field, count)` for a new count, or None if the reading is
+        ignored. `field` is the `id_name` of the focused field.
+        """
+        if grams < self.empty_below:
+            self.field = self.weight = None
+            return None
+        if self.field is None:
+            if field not in self.coin_weights:
+                return None
+            self.field = field
+        if grams == self.weight:
+            return None
+        self.weight = grams
+        return self.field, coins_for_weight(grams, self.coin_weights[self.field])
+
+
+class ScaleReader:
+    """
+    Reads weights from a counting scale on a serial port.
+
+    The port is read through the asyncio event loop, so waiting for the
+    scale never blocks the UI.
+    """
+
+    def __init__(self, path, baudrate=9600):
+        self.path = path
+        self.baudrate = baudrate
+        self.fd = None
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(self.fd):
+            tty.setraw(self.fd, termios.TCSANOW)
+            attrs = termios.tcgetattr(self.fd)
+            speed = getattr(termios, f'B{self.baudrate}')
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+    async def weights(self):
+        """Yield the weight in grams of every stable reading until the port is closed."""
+        if self.fd is None:
+            self.open()
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        buffer = b''
+
+        def on_readable():
+            nonlocal buffer
+            try:
+                data = os.read(self.fd, 1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                # EIO once the other end of a pseudo-terminal is closed.
+                data = b''
+            if not data:
+                loop.remove_reader(self.fd)
+                lines.put_nowait(None)
+                return
+            *complete, buffer = (buffer + data).replace(b'\r', b'\n').split(b'\n')
+            for line in complete:
+                if line:
+                    lines.put_nowait(line.decode('ascii', 'replace'))
+
+        loop.add_reader(self.fd, on_readable)
+        try:
+            while True:
+                line = await lines.get()
+                if line is None:
+                    return
+                weight = parse_weight(line)
+                if weight is not None:
+                    yield weight
+        finally:
+            if self.fd is not None:
+                loop.remove_reader(self.fd)
+            self.close()
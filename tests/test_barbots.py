@@ -0,0 +1,23 @@
+import json
+import time
+
+from barbots import BarbotDirectory, PrefixIndex
+
+
+def test_prefix_index():
+    index = PrefixIndex(['uk', 'Uwe', 'ulli', 'bob', 'Bobby'])
+    assert index.search('u') == ['uk', 'ulli', 'Uwe']
+    assert index.search('BOB') == ['bob', 'Bobby']
+    assert index.search('u', limit=1) == ['uk']
+    assert index.search('x') == []
+    assert index.search('') == []
+
+
+def test_directory_falls_back_to_cache(tmp_path):
+    cache_path = str(tmp_path / 'barbots.json')
+    with open(cache_path, 'w') as cache_fh:
+        json.dump({'fetched_at': time.time() - 10, 'names': ['uk', 'ulli']}, cache_fh)
+    # Stale cache and an unreachable API, the cached names are still used.
+    directory = BarbotDirectory(url='http://127.0.0.1:1/barbots/', cache_path=cache_path, ttl=1)
+    directory.refresh()
+    assert directory.suggest('ul') == ['ulli']
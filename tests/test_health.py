@@ -0,0 +1,28 @@
+import socket
+
+import pytest
+
+from health import HealthMonitor, probe_printer
+
+
+def test_health_monitor_caches_results():
+    def broken():
+        raise OSError('connection refused')
+
+    monitor = HealthMonitor({'API': lambda: None, 'Drucker': broken})
+    assert monitor.status('API') is None
+    assert monitor.failures() == []
+    monitor.check()
+    assert monitor.status('API')['ok']
+    assert monitor.failures() == [('Drucker', 'connection refused')]
+
+
+def test_probe_printer_tcp():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    probe_printer(f'tcp://127.0.0.1:{port}')
+    server.close()
+    with pytest.raises(OSError):
+        probe_printer(f'tcp://127.0.0.1:{port}')
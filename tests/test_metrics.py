@@ -0,0 +1,68 @@
+from urllib.request import urlopen
+
+from metrics import Counter, Gauge, Histogram, Registry, start_http_server
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    counter = Counter('test_errors_total', 'Errors.', registry=registry)
+    counter.inc(endpoint='count')
+    counter.inc(2, endpoint='count')
+    gauge = Gauge('test_queue_depth', 'Queue depth.', registry=registry)
+    gauge.set_function(lambda: 3)
+    histogram = Histogram('test_seconds', 'Seconds.', buckets=(0.1, 1.0), registry=registry)
+    histogram.observe(0.5, printer='a')
+    histogram.observe(2.0, printer='a')
+    assert registry.render().splitlines() == [
+        '# HELP test_errors_total Errors.',
+        '# TYPE test_errors_total counter',
+        'test_errors_total{endpoint="count"} 3.0',
+        '# HELP test_queue_depth Queue depth.',
+        '# TYPE test_queue_depth gauge',
+        'test_queue_depth 3.0',
+        '# HELP test_seconds Seconds.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{printer="a",le="0.1"} 0.0',
+        'test_seconds_bucket{printer="a",le="1.0"} 1.0',
+        'test_seconds_bucket{printer="a",le="+Inf"} 2.0',
+        'test_seconds_sum{printer="a"} 2.5',
+        'test_seconds_count{printer="a"} 2.0',
+    ]
+
+
+def test_http_server():
+    registry = Registry()
+    Counter('test_counts_total', 'Counts.', registry=registry).inc()
+    server = start_http_server(0, registry=registry)
+    try:
+        body = urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics').read().decode()
+    finally:
+        server.shutdown()
+    assert 'test_counts_total 1.0' in body
+
+
+def test_counter_starts_at_zero():
+    registry = Registry()
+    Counter('test_counts_total', 'Counts.', registry=registry)
+    Counter('test_errors_total', 'Errors.', registry=registry, labels=({'endpoint': 'count'},))
+    assert 'test_counts_total 0.0' in registry.render()
+    assert 'test_errors_total{endpoint="count"} 0.0' in registry.render()
+
+
+def test_state_kept_between_runs(tmp_path):
+    state_path = str(tmp_path / 'metrics.json')
+
+    def run():
+        registry = Registry()
+        counter = Counter('test_counts_total', 'Counts.', registry=registry)
+        histogram = Histogram('test_seconds', 'Seconds.', buckets=(0.1, 1.0), registry=registry)
+        registry.load_state(state_path)
+        counter.inc()
+        histogram.observe(0.5, printer='a')
+        return registry.render()
+
+    run()
+    rendered = run()
+    assert 'test_counts_total 2.0' in rendered
+    assert 'test_seconds_count{printer="a"} 2.0' in rendered
+    assert 'test_seconds_sum{printer="a"} 1.0' in rendered
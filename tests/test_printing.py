@@ -0,0 +1,173 @@
+import pytest
+
+import printing
+from metrics import PRINT_SECONDS
+from printing import PrinterConnection, PrinterPool
+
+
+def status_packet(status_type, phase_type=0x00, error_1=0x00, error_2=0x00):
+    """A 32 byte status reply of a QL printer with 62mm endless tape."""
+    data = bytearray(32)
+    data[0:3] = b'\x80\x20\x42'
+    data[8] = error_1
+    data[9] = error_2
+    data[10] = 62
+    data[11] = 0x0A
+    data[18] = status_type
+    data[19] = phase_type
+    return bytes(data)
+
+
+PRINTING_COMPLETED = status_packet(0x01, phase_type=0x01)
+WAITING_TO_RECEIVE = status_packet(0x06, phase_type=0x00)
+CUTTER_JAM = status_packet(0x02, error_1=1 << 2)
+
+
+class FakeBackend:
+    instances = []
+    responses = []
+
+    def __init__(self, device_specifier):
+        self.written = []
+        self.disposed = False
+        self.responses = list(FakeBackend.responses)
+        FakeBackend.instances.append(self)
+
+    def write(self, data):
+        self.written.append(data)
+
+    def read(self, length=32):
+        if self.responses:
+            return self.responses.pop(0)
+        return b''
+
+    def dispose(self):
+        self.disposed = True
+
+
+def test_printer_connection_reuses_backend(monkeypatch):
+    FakeBackend.instances = []
+    FakeBackend.responses = []
+    monkeypatch.setattr(printing, 'backend_factory', lambda name: {'backend_class': FakeBackend})
+    monkeypatch.setattr(printing, 'probe_printer', lambda printer, timeout: None)
+    conn = PrinterConnection('tcp://localhost:9100', backend='network')
+    first = conn.submit(b'label one')
+    second = conn.submit(b'label two')
+    assert first.result(timeout=5)['outcome'] == 'sent'
+    assert second.result(timeout=5)['outcome'] == 'sent'
+    conn.close()
+    assert len(FakeBackend.instances) == 1
+    assert FakeBackend.instances[0].written == [b'label one', b'label two']
+    assert FakeBackend.instances[0].disposed
+
+
+def test_printer_pool_fails_over_unreachable_host(monkeypatch):
+    def probe_printer(printer, timeout):
+        if printer == 'tcp://a':
+            raise TimeoutError('timed out')
+
+    FakeBackend.instances = []
+    FakeBackend.responses = []
+    monkeypatch.setattr(printing, 'backend_factory', lambda name: {'backend_class': FakeBackend})
+    monkeypatch.setattr(printing, 'probe_printer', probe_printer)
+    pool = PrinterPool(['tcp://a', 'tcp://b'], backend='network')
+    try:
+        assert pool.submit(b'label').result(timeout=5)['printer'] == 'tcp://b'
+    finally:
+        pool.close()
+    # No connection was opened to the host that didn't answer the probe.
+    assert len(FakeBackend.instances) == 1
+    assert pool.stats['tcp://a']['errors'] == 1
+
+
+def send_with_responses(monkeypatch, responses, status_timeout=10.0):
+    FakeBackend.instances = []
+    FakeBackend.responses = responses
+    monkeypatch.setattr(printing, 'backend_factory', lambda name: {'backend_class': FakeBackend})
+    conn = PrinterConnection('usb://0x04f9:0x2042', backend='pyusb', status_timeout=status_timeout)
+    try:
+        return conn.submit(b'label').result(timeout=5)
+    finally:
+        conn.close()
+
+
+def test_printer_connection_printed(monkeypatch):
+    status = send_with_responses(monkeypatch, [b'', b'garbage', PRINTING_COMPLETED, WAITING_TO_RECEIVE])
+    assert status['outcome'] == 'printed'
+    assert status['did_print']
+    assert status['ready_for_next_job']
+
+
+def test_printer_connection_error(monkeypatch):
+    status = send_with_responses(monkeypatch, [CUTTER_JAM, PRINTING_COMPLETED])
+    assert status['outcome'] == 'error'
+    assert status['printer_state']['errors'] == ['Tape cutter jam']
+    assert not status['did_print']
+
+
+def test_printer_connection_status_timeout(monkeypatch):
+    status = send_with_responses(monkeypatch, [PRINTING_COMPLETED], status_timeout=0.05)
+    # Printed, but the printer never reported it is ready for the next job.
+    assert status['outcome'] == 'printed'
+    assert not status['ready_for_next_job']
+    status = send_with_responses(monkeypatch, [], status_timeout=0.05)
+    assert status['outcome'] == 'sent'
+    assert not status['did_print']
+
+
+def test_printer_pool_round_robin():
+    pool = PrinterPool(['a', 'b', 'c'])
+    assert [pool.candidates()[0] for i in range(4)] == ['a', 'b', 'c', 'a']
+
+
+def test_printer_pool_fails_over(monkeypatch):
+    # Other tests print on the same printer names.
+    monkeypatch.setattr(PRINT_SECONDS, '_values', {})
+
+    def job(printer):
+        if printer == 'a':
+            raise OSError('paper jam')
+        return printer
+
+    pool = PrinterPool(['a', 'b'])
+    assert pool.run(job) == 'b'
+    assert pool.stats['a']['errors'] == 1
+    assert not pool.is_up('a')
+    # The failed printer is tried last until `retry_after` has passed.
+    assert pool.candidates() == ['b', 'a']
+    assert pool.latency('b') is not None
+    # Only the printed job is timed.
+    assert 'printer="b"' in PRINT_SECONDS.render()
+    assert 'printer="a"' not in PRINT_SECONDS.render()
+
+
+def test_printer_pool_all_down():
+    def job(printer):
+        raise OSError('offline')
+
+    pool = PrinterPool(['a', 'b'], strategy='least-queued')
+    with pytest.raises(OSError):
+        pool.run(job)
+
+
+def test_printer_pool_no_failover_on_other_errors():
+    tried = []
+
+    def job(printer):
+        tried.append(printer)
+        raise TimeoutError('no answer, maybe printed')
+
+    pool = PrinterPool(['a', 'b'])
+    with pytest.raises(TimeoutError):
+        pool.run(job, failover_on=(ConnectionError,))
+    assert tried == ['a']
+
+
+def test_printer_pool_keeps_state_between_runs(tmp_path):
+    state_path = str(tmp_path / 'printers.json')
+    pool = PrinterPool(['a', 'b', 'c'], state_path=state_path)
+    assert pool.run(lambda printer: printer) == 'a'
+    # The next run of the app continues with the next printer and knows the timings.
+    pool = PrinterPool(['a', 'b', 'c'], state_path=state_path)
+    assert pool.latency('a') is not None
+    assert pool.run(lambda printer: printer) == 'b'
@@ -0,0 +1,54 @@
+from quickentry import QuickEntryParser
+
+DENOMINATIONS = [
+    ('50,00', '5000'),
+    ('20,00', '2000'),
+    ('2,00', '200'),
+    ('0,50', '50'),
+    ('Safebag', 'safebag_in_cent'),
+]
+
+
+def test_parse_expression():
+    parser = QuickEntryParser(DENOMINATIONS)
+    values, errors = parser.parse('50x3 20x7 2x41 +safebag 1234 0,5x2 0.50x1')
+    assert values == {'5000': 3, '2000': 7, '200': 41, 'safebag_in_cent': 1234, '50': 3}
+    assert errors == []
+
+
+def test_parse_errors():
+    parser = QuickEntryParser(DENOMINATIONS)
+    values, errors = parser.parse('50x3 7x2 20x 1234 +foo')
+    assert values == {'5000': 3}
+    assert errors == ['7x2', '20x', '1234', '+foo']
+
+
+def test_parse_only_changed_tokens():
+    parser = QuickEntryParser(DENOMINATIONS)
+    parser.parse('50x3 20x7 2x41')
+    parsed = []
+    parse_token = parser.parse_token
+
+    def counting_parse_token(token):
+        parsed.append(token)
+        return parse_token(token)
+
+    parser.parse_token = counting_parse_token
+    values, errors = parser.parse('50x3 20x8 2x41')
+    assert values == {'5000': 3, '2000': 8, '200': 41}
+    assert parsed == ['20x8']
+
+
+def test_parse_field_without_number():
+    parser = QuickEntryParser(DENOMINATIONS)
+    assert parser.parse('50x3 +safebag') == ({'5000': 3}, ['+safebag'])
+    assert parser.parse('+safebag +safebag 5') == ({'safebag_in_cent': 5}, ['+safebag'])
+    assert parser.parse('+safebag 50x1') == ({'5000': 1}, ['+safebag'])
+
+
+def test_format_values():
+    parser = QuickEntryParser(DENOMINATIONS)
+    values = {'5000': 3, '200': 41, '50': 2, 'safebag_in_cent': 1234, '2000': 0}
+    text = parser.format(values)
+    assert text == '50x3 2x41 0,50x2 +safebag 1234'
+    assert parser.parse(text) == ({'5000': 3, '200': 41, '50': 2, 'safebag_in_cent': 1234}, [])
@@ -1,7 +1,16 @@
+import os
 import tempfile
 from decimal import Decimal
 
-from rendering import make_zettel
+import pytest
+from PIL import Image
+
+from rendering import DITHER_MODES, halfblock_lines, make_raster, make_zettel, prepare_image
+
+TEST_IMAGES = [
+    os.path.join(os.path.dirname(__file__), '..', 'testimg.png'),
+    os.path.join(os.path.dirname(__file__), '..', 'testimg2.png'),
+]
 
 
 def test_make_zettel():
@@ -54,4 +63,48 @@ def test_make_zettel():
     }
     with tempfile.TemporaryDirectory() as tmpdir:
         res = make_zettel(context, tmpdir, do_open=True)
-        assert res == tmpdir + 'out.png'
\ No newline at end of file
+        assert res == tmpdir + 'out.png'
+
+
+def test_make_raster_cut_between():
+    data = make_raster(TEST_IMAGES, 'QL-700', cut_between=True, cut_at_end=True)
+    assert data.count(b'\x1b\x69\x41\x01') == 2
+    assert data.count(b'\x1b\x40') == 1
+
+
+def test_make_raster_cut_at_end_only():
+    data = make_raster(TEST_IMAGES, 'QL-700', cut_between=False, cut_at_end=True)
+    assert data.count(b'\x1b\x69\x41\x02') == 2
+    assert data.count(b'\x1b\x40') == 1
+
+
+def test_make_raster_cut_between_not_at_end():
+    data = make_raster(TEST_IMAGES, 'QL-700', cut_between=True, cut_at_end=False)
+    # auto cut after the first label, but not after the last one
+    assert data.count(b'\x1b\x69\x4d\x40') == 1
+    assert data.count(b'\x1b\x69\x4d\x00') == 1
+    assert data.index(b'\x1b\x69\x4d\x40') < data.index(b'\x1b\x69\x4d\x00')
+    assert data.count(b'\x1b\x69\x4b\x00') == 2
+
+
+def test_make_raster_too_many_labels_without_cut():
+    with pytest.raises(ValueError):
+        make_raster(TEST_IMAGES * 128, 'QL-700', cut_between=False, cut_at_end=True)
+
+
+def test_prepare_image():
+    for mode in DITHER_MODES:
+        im = prepare_image(TEST_IMAGES[1], mode=mode)
+        assert im.mode == '1'
+        assert im.size[0] == 696
+        # blank rows at the bottom are trimmed
+        assert im.size[1] < 635 * 696 // 732
+
+
+def test_halfblock_lines():
+    image = Image.new('1', (8, 8), 1)
+    image.paste(0, (0, 0, 4, 2))
+    image.paste(0, (4, 6, 8, 8))
+    assert halfblock_lines(image, 4) == ['\u2580\u2580  ', '  \u2584\u2584']
+    lines = halfblock_lines(prepare_image(TEST_IMAGES[0]), 80)
+    assert all(len(line) == 80 for line in lines)
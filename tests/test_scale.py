@@ -0,0 +1,55 @@
+import asyncio
+import os
+
+from scale import COIN_WEIGHTS, CoinCounter, ScaleReader, coins_for_weight, parse_coin_weights, parse_weight
+
+
+def test_parse_weight():
+    assert parse_weight('ST,GS,+  75.00 g') == 75.0
+    assert parse_weight('  0,125 kg\r') == 125.0
+    assert parse_weight('US,GS,+  74.10 g') is None
+    assert parse_weight('hello') is None
+
+
+def test_coin_weights():
+    weights = parse_coin_weights('200=8.6')
+    assert weights['200'] == 8.6
+    assert weights['100'] == COIN_WEIGHTS['100']
+    assert coins_for_weight(8.5 * 41 + 2, COIN_WEIGHTS['200']) == 41
+
+
+def test_coin_counter():
+    counter = CoinCounter(COIN_WEIGHTS)
+    assert counter.reading(8.5 * 10, '200') == ('200', 10)
+    # The same weight again, or the focus moving on, doesn't count again.
+    assert counter.reading(8.5 * 10, '200') is None
+    assert counter.reading(8.5 * 10, '100') is None
+    # More coins added after the focus moved still belong to the first field.
+    assert counter.reading(8.5 * 12, '100') == ('200', 12)
+    # Emptying the scale doesn't reset the count.
+    assert counter.reading(0.0, '100') is None
+    assert counter.reading(7.5 * 4, '100') == ('100', 4)
+    assert counter.reading(0.0, 'safebag_in_cent') is None
+    assert counter.reading(7.5 * 4, 'safebag_in_cent') is None
+
+
+def test_scale_reader_pty():
+    master, slave = os.openpty()
+    reader = ScaleReader(os.ttyname(slave))
+    reader.open()
+
+    async def read():
+        weights = []
+        os.write(master, b'US,GS,+  10.00 g\r\nST,GS,+  75.00 g\r\nST,GS,')
+        async for weight in reader.weights():
+            weights.append(weight)
+            if len(weights) == 2:
+                break
+            os.write(master, b'+  82.50 g\r\n')
+        return weights
+
+    try:
+        assert asyncio.run(asyncio.wait_for(read(), 5)) == [75.0, 82.5]
+    finally:
+        os.close(master)
+        os.close(slave)